@@ -1,10 +1,23 @@
 import io
+import os
 import csv
 import json
+import copy
+import atexit
+import logging
+import threading
+import hashlib
+import sqlite3
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
 import datetime as dt
-from dataclasses import dataclass
+from collections import OrderedDict, defaultdict
+from contextlib import closing
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
 from typing import List
 from pypdf import PdfReader, PdfWriter
+import numpy as np
 import pandas as pd
 import streamlit as st
 from reportlab.lib.pagesizes import A4
@@ -16,8 +29,28 @@ from reportlab.pdfbase.ttfonts import TTFont
 pdfmetrics.registerFont(TTFont("BodoniF", "bodonif.ttf"))
 from reportlab.platypus import Table, TableStyle
 
+# orjson (Rust) est nettement plus rapide que json pour les colonnes items/materials/serials ;
+# on retombe sur la librairie standard s'il n'est pas installé.
+try:
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    # orjson sérialise les dataclasses directement, sans copie intermédiaire en dicts
+    def json_dumps_dataclasses(objs) -> str:
+        return orjson.dumps(objs).decode()
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+    def json_dumps_dataclasses(objs) -> str:
+        return json.dumps([asdict(o) for o in objs])
+
 # -------------------- Data models --------------------
-@dataclass
+@dataclass(slots=True)
 class StockItem:
     name: str
     color: str
@@ -25,7 +58,7 @@ class StockItem:
     entry_date: str
     quantity: int
 
-@dataclass
+@dataclass(slots=True)
 class Company:
     name: str
     siret: str = ""
@@ -34,7 +67,7 @@ class Company:
     phone: str = ""
     email: str = ""
 
-@dataclass
+@dataclass(slots=True)
 class Client:
     name: str
     address: str
@@ -42,13 +75,13 @@ class Client:
     email: str
     city: str
 
-@dataclass
+@dataclass(slots=True)
 class Item:
     description: str
     unit_price: float
     quantity: int
 
-@dataclass
+@dataclass(slots=True)
 class Quote:
     number: str
     date: dt.date
@@ -58,10 +91,10 @@ class Quote:
     discount_is_percent: bool
     place: str
     status: str = "quote"  # quote or invoice
-    materials: list = None  # [{product, name, lot, qty}]
-    serials: list = None     # [{serial, product, materials:[{name, lot, qty}]}]
+    materials: list = field(default_factory=list)  # [{product, name, lot, qty}]
+    serials: list = field(default_factory=list)    # [{serial, product, materials:[{name, lot, qty}]}]
 
-@dataclass
+@dataclass(slots=True)
 class RawMaterial:
     name: str = ""
     color: str = ""
@@ -71,22 +104,28 @@ class RawMaterial:
 
 
 # -------------------- CSV loaders --------------------
-def load_catalog(path="catalog.csv") -> List[Item]:
+# Les loaders sont mis en cache par Streamlit : `stamp` (mtime, taille) fait partie
+# de la clé, le cache est donc invalidé dès que le fichier change sur le disque.
+def file_stamp(path: str):
     try:
-        items = []
-        with open(path, newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                items.append(Item(row["description"], float(row["unit_price"]), int(row["quantity"])))
-        return items
-    except FileNotFoundError:
+        return os.path.getmtime(path), os.path.getsize(path)
+    except OSError:
+        return None
+
+@st.cache_data(show_spinner=False)
+def load_catalog(path="catalog.csv", stamp=None) -> List[Item]:
+    try:
+        df = pd.read_csv(path, engine="c", dtype={"description": str}, keep_default_na=False)
+        return [Item(d, p, q) for d, p, q in zip(df["description"], df["unit_price"].astype(float), df["quantity"].astype(int))]
+    except (FileNotFoundError, pd.errors.EmptyDataError):
         return []
 
-def load_company(path="company.csv") -> dict:
+@st.cache_data(show_spinner=False)
+def load_company(path="company.csv", stamp=None) -> dict:
     try:
         with open(path, newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            row = next(reader)
+            reader = csv.reader(f)
+            row = dict(zip(next(reader, []), next(reader, [])))
             return {
                 "name": row.get("name", ""),
                 "siret": row.get("siret", ""),
@@ -98,77 +137,138 @@ def load_company(path="company.csv") -> dict:
     except FileNotFoundError:
         return {"name": "", "siret": "", "address": "", "rm": "", "phone": "", "email": ""}
     
-def load_clients(path="clients.csv") -> List[Client]:
+@st.cache_data(show_spinner=False)
+def load_clients(path="clients.csv", stamp=None) -> List[Client]:
     try:
-        clients = []
-        with open(path, newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                clients.append(Client(row["name"], row["address"], row["phone"], str(row["email"]), row["city"]))
-        return clients
-    except FileNotFoundError:
+        df = pd.read_csv(path, engine="c", dtype=str, keep_default_na=False)
+        return [Client(*row) for row in df[["name", "address", "phone", "email", "city"]].itertuples(index=False, name=None)]
+    except (FileNotFoundError, pd.errors.EmptyDataError):
         return []
 
-def load_quotes(path="quotes.csv") -> List[Quote]:
+@st.cache_data(show_spinner=False)
+def load_quotes(path="quotes.csv", stamp=None) -> List[Quote]:
     try:
-        quotes = []
-        with open(path, newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                # Charger les lignes d’articles
-                items = [Item(**it) for it in json.loads(row["items"])]
-
-                # Charger client
-                client = Client(
-                    row["client_name"], row["client_address"],
-                    row["client_phone"], row["client_email"], row["client_city"]
-                )
-
-                # Charger materials (compatibilité ancienne version)
-                try:
-                    materials = json.loads(row.get("materials", "[]"))
-                except:
-                    materials = []
-
-                # Charger serials (nouveau suivi traçabilité)
-                try:
-                    serials = json.loads(row.get("serials", "[]"))
-                except:
-                    serials = []
-
-                quotes.append(Quote(
-                    number=row["number"],
-                    date=dt.datetime.strptime(row["date"], "%Y-%m-%d").date(),
-                    client=client,
-                    items=items,
-                    discount_value=float(row["discount_value"]),
-                    discount_is_percent=row["discount_is_percent"] == "True",
-                    place=row["place"],
-                    status=row.get("status", "quote"),
-                    materials=materials,
-                    serials=serials
-                ))
-        return quotes
-    except FileNotFoundError:
+        df = pd.read_csv(path, engine="c", dtype=str, keep_default_na=False)
+    except (FileNotFoundError, pd.errors.EmptyDataError):
         return []
 
-    
-def load_stock(path="stock.csv") -> List[StockItem]:
-    try:
-        stock = []
-        with open(path, newline="", encoding="utf-8") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                stock.append(StockItem(
-                    name=row["name"],
-                    color=row.get("color", ""),  # <- défaut si pas présent
-                    lot_number=row["lot_number"],
-                    entry_date=row["entry_date"],
-                    quantity=int(row["quantity"])
-                ))
-        return stock
-    except FileNotFoundError:
-        return []
+    # Colonnes absentes des anciennes versions du fichier
+    for col, default in (("status", "quote"), ("materials", "[]"), ("serials", "[]")):
+        if col not in df:
+            df[col] = default
+    # Le fichier est un journal (voir save_one_quote) : la dernière ligne d'un numéro l'emporte
+    df = df.drop_duplicates("number", keep="last")
+    df["date"] = pd.to_datetime(df["date"], format="%Y-%m-%d").dt.date
+    df["discount_value"] = df["discount_value"].astype(float)
+
+    quotes = []
+    for (number, date, cname, caddr, cphone, cemail, ccity, items_s,
+         discount_value, discount_is_percent, place, status, mats_s, serials_s) in df[[
+            "number", "date", "client_name", "client_address", "client_phone", "client_email", "client_city",
+            "items", "discount_value", "discount_is_percent", "place", "status", "materials", "serials"
+         ]].itertuples(index=False, name=None):
+        # Charger les lignes d’articles
+        items = [Item(**it) for it in json_loads(items_s)]
+
+        # Charger materials (compatibilité ancienne version)
+        try:
+            materials = json_loads(mats_s)
+        except:
+            materials = []
+
+        # Charger serials (nouveau suivi traçabilité)
+        try:
+            serials = json_loads(serials_s)
+        except:
+            serials = []
+
+        quotes.append(Quote(
+            number=number,
+            date=date,
+            client=Client(cname, caddr, cphone, cemail, ccity),
+            items=items,
+            discount_value=discount_value,
+            discount_is_percent=discount_is_percent == "True",
+            place=place,
+            status=status,
+            materials=materials,
+            serials=serials
+        ))
+    return quotes
+
+
+# -------------------- Background saves --------------------
+# Les écritures du stock et des devis passent par un thread unique : le rerun n'attend pas
+# le disque. Les demandes sont traitées dans l'ordre d'arrivée ; une nouvelle demande pour
+# une cible déjà en attente la remplace et passe en fin de file, seule la dernière compte.
+# submit() rend un Future résolu une fois l'écriture faite (ou en échec), y compris pour
+# les demandes remplacées, qui partagent le sort de celle qui les remplace. Son résultat est
+# celui de la fonction d'écriture : l'empreinte du fichier juste après l'écriture.
+class SaveFlusher:
+    def __init__(self):
+        self._pending = OrderedDict()
+        self._busy = False
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, name="save-flusher", daemon=True).start()
+
+    def submit(self, target: str, fn, *args) -> Future:
+        future = Future()
+        with self._cond:
+            replaced = self._pending.pop(target, None)
+            futures = (replaced[2] if replaced else []) + [future]
+            self._pending[target] = (fn, args, futures)
+            self._cond.notify_all()
+        return future
+
+    def flush(self):
+        with self._cond:
+            self._cond.wait_for(lambda: not self._pending and not self._busy)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                _, (fn, args, futures) = self._pending.popitem(last=False)
+                self._busy = True
+            try:
+                result = fn(*args)
+            except Exception as exc:
+                logging.exception("Échec de l'écriture en arrière-plan (%s)", fn.__name__)
+                for future in futures:
+                    future.set_exception(exc)
+            else:
+                for future in futures:
+                    future.set_result(result)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+@st.cache_resource
+def save_flusher() -> SaveFlusher:
+    flusher = SaveFlusher()
+    atexit.register(flusher.flush)  # on vide la file avant l'arrêt du serveur
+    return flusher
+
+def write_ok(future: Future) -> bool:
+    # En attente ou réussie : une écriture en échec ne compte pas comme sauvegardée
+    return not future.done() or future.exception() is None
+
+# Dernière écriture en arrière-plan de la session, par fichier : tant qu'elle n'a pas
+# réussi, le fichier sur disque est en retard sur la mémoire et session_db ne le relit pas
+def track_write(path: str, future: Future):
+    st.session_state.setdefault("_writes", {})[path] = future
+
+def has_unsaved_writes(path: str) -> bool:
+    future = st.session_state.get("_writes", {}).get(path)
+    return future is not None and not (future.done() and future.exception() is None)
+
+def written_stamp(path: str):
+    # Empreinte laissée par la dernière écriture réussie de la session, None sinon
+    future = st.session_state.get("_writes", {}).get(path)
+    if future is None or not future.done() or future.exception() is not None:
+        return None
+    return future.result()
 
 # -------------------- CSV savers --------------------
 def save_catalog(items: List[Item], path="catalog.csv"):
@@ -177,12 +277,14 @@ def save_catalog(items: List[Item], path="catalog.csv"):
         writer.writeheader()
         for it in items:
             writer.writerow({"description": it.description, "unit_price": it.unit_price, "quantity": it.quantity})
+    load_catalog.clear()
 
 def save_company(company: dict, path="company.csv"):
     with open(path, "w", newline="", encoding="utf-8") as f:
         writer = csv.DictWriter(f, fieldnames=["name", "siret", "address", "rm", "phone", "email"])
         writer.writeheader()
         writer.writerow(company)
+    load_company.clear()
 
 def save_clients(clients: List[Client], path="clients.csv"):
     with open(path, "w", newline="", encoding="utf-8") as f:
@@ -190,85 +292,369 @@ def save_clients(clients: List[Client], path="clients.csv"):
         writer.writeheader()
         for cli in clients:
             writer.writerow({"name": cli.name, "address": cli.address, "phone": cli.phone, "email": cli.email, "city": cli.city})
+    load_clients.clear()
+
+QUOTES_FIELDS = [
+    "number","date","client_name","client_address","client_phone","client_email","client_city",
+    "items","discount_value","discount_is_percent","place","status","materials","serials"
+]
+
+# Compactage du journal quotes.csv dès que les lignes périmées (numéro réécrit plus loin)
+# atteignent ce nombre ou dépassent le nombre de devis distincts
+QUOTES_MAX_STALE_ROWS = 50
+
+def quote_row(q: Quote) -> tuple:
+    return (
+        q.number, q.date.isoformat(),
+        q.client.name, q.client.address, q.client.phone, q.client.email, q.client.city,
+        json_dumps_dataclasses(q.items),
+        q.discount_value, q.discount_is_percent, q.place, q.status,
+        json_dumps(q.materials) if q.materials else "[]",
+        json_dumps(q.serials) if q.serials else "[]",
+    )
+
+def write_quotes(rows: list, path="quotes.csv"):
+    # Lignes construites en listes simples puis écrites d'un bloc par writerows (C),
+    # au lieu d'un DictWriter.writerow par devis. Écriture dans un fichier temporaire du même
+    # dossier puis os.replace : un lecteur voit l'ancien fichier ou le nouveau, jamais un
+    # fichier tronqué.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with open(fd, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(QUOTES_FIELDS)
+            writer.writerows(rows)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return file_stamp(path)
+
+def append_quote(row: tuple, path="quotes.csv"):
+    with open(path, "a", newline="", encoding="utf-8") as f:
+        csv.writer(f).writerow(row)
+    compact_quotes(path)
+    return file_stamp(path)
+
+def compact_quotes(path="quotes.csv"):
+    # Exécuté par le thread d'écriture après chaque ajout, jamais pendant le rerun : le compte
+    # des lignes périmées vient du fichier lui-même, quelle que soit la session qui a fait les
+    # ajouts. Réécrit sans les lignes périmées, chaque devis gardant la place de sa dernière
+    # ligne (comme drop_duplicates(keep="last") au chargement).
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        rows = [r for r in reader if r]
+    latest = {}
+    for r in rows:
+        latest.pop(r[0], None)
+        latest[r[0]] = r
+    stale = len(rows) - len(latest)
+    if stale >= QUOTES_MAX_STALE_ROWS or stale > len(latest):
+        write_quotes(list(latest.values()), path)
+
+# Empreintes des dernières écritures de la session, par fichier (voir session_db, qui les
+# oublie quand il relit ce fichier depuis le disque)
+def session_fps() -> dict:
+    return st.session_state.setdefault("_fps", {})
+
+# Empreinte de la dernière ligne écrite pour chaque devis de la session, avec le Future de
+# son écriture : une sauvegarde sans modification ne déclenche aucune écriture, sauf si la
+# précédente a échoué ou si le fichier a été relu depuis
+def quote_unchanged(number: str, row: tuple, path="quotes.csv") -> bool:
+    last = session_fps().get(path, {}).get(number)
+    return last is not None and last[0] == hash(row) and write_ok(last[1])
 
 def save_quotes(quotes: List[Quote], path="quotes.csv"):
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=[
-            "number","date","client_name","client_address","client_phone","client_email","client_city",
-            "items","discount_value","discount_is_percent","place","status","materials","serials"
-        ])
-        writer.writeheader()
-        for q in quotes:
-            writer.writerow({
-                "number": q.number,
-                "date": q.date.isoformat(),
-                "client_name": q.client.name,
-                "client_address": q.client.address,
-                "client_phone": q.client.phone,
-                "client_email": q.client.email,
-                "client_city": q.client.city,
-                "items": json.dumps([vars(it) for it in q.items]),
-                "discount_value": q.discount_value,
-                "discount_is_percent": q.discount_is_percent,
-                "place": q.place,
-                "status": q.status,
-                "materials": json.dumps(q.materials) if q.materials else "[]",
-                "serials": json.dumps(q.serials) if q.serials else "[]"
-            })
-
-def save_stock(stock: List[StockItem], path="stock.csv"):
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=["name", "color", "lot_number", "entry_date", "quantity"])
-        writer.writeheader()
-        for s in stock:
-            writer.writerow({
-                "name": s.name,
-                "color": s.color,
-                "lot_number": s.lot_number,
-                "entry_date": s.entry_date,
-                "quantity": s.quantity
-            })
+    # Les lignes sont figées ici ; l'écriture elle-même part au thread d'écriture
+    rows = [quote_row(q) for q in quotes]
+    future = save_flusher().submit("quotes", write_quotes, rows, path)
+    track_write(path, future)
+    load_quotes.clear()
+    st.session_state.pop("quotes_by_no", None)
+    session_fps()[path] = {row[0]: (hash(row), future) for row in rows}
+
+def save_one_quote(q: Quote, quotes: List[Quote], path="quotes.csv"):
+    # quotes.csv sert de journal : un devis modifié est ajouté en fin de fichier (la dernière
+    # ligne d'un numéro l'emporte au chargement), compact_quotes retire ensuite les lignes
+    # périmées en arrière-plan. Un fichier absent ou sans l'en-tête actuel est réécrit en
+    # entier par save_quotes.
+    row = quote_row(q)
+    st.session_state.pop("quotes_by_no", None)
+    if quote_unchanged(q.number, row, path):
+        return
+    if not quotes_header_ok(path):
+        save_quotes(quotes, path)
+        return
+    future = save_flusher().submit(f"quotes:{q.number}", append_quote, row, path)
+    track_write(path, future)
+    load_quotes.clear()
+    session_fps().setdefault(path, {})[q.number] = (hash(row), future)
+
+def quotes_header_ok(path="quotes.csv") -> bool:
+    # Seule la première ligne est lue
+    try:
+        with open(path, newline="", encoding="utf-8") as f:
+            return next(csv.reader(f), None) == QUOTES_FIELDS
+    except FileNotFoundError:
+        return False
+
+# -------------------- Stock (sqlite) --------------------
+# Le stock vit dans une table sqlite indexée par lot : une sauvegarde n'écrit que les lignes
+# modifiées au lieu de réécrire tout le fichier. stock.csv ne sert qu'à initialiser la base
+# quand stock.db n'existe pas encore : il n'est ensuite ni relu ni mis à jour, les
+# modifications faites à la main dans stock.csv sont donc ignorées (supprimer stock.db pour
+# repartir du CSV).
+STOCK_UPSERT = """
+    INSERT INTO stock (lot_number, name, color, entry_date, quantity) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(lot_number) DO UPDATE SET
+        name = excluded.name, color = excluded.color,
+        entry_date = excluded.entry_date, quantity = excluded.quantity
+"""
+
+def stock_connect(path="stock.db", csv_path="stock.csv") -> sqlite3.Connection:
+    exists = os.path.exists(path)
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS stock "
+        "(lot_number TEXT PRIMARY KEY, name TEXT, color TEXT, entry_date TEXT, quantity INTEGER)"
+    )
+    if not exists:
+        try:
+            df = pd.read_csv(csv_path, engine="c", dtype=str, keep_default_na=False)
+        except (FileNotFoundError, pd.errors.EmptyDataError):
+            return conn
+        if "color" not in df:
+            df["color"] = ""  # <- défaut si pas présent
+        with conn:
+            conn.executemany(STOCK_UPSERT, zip(
+                df["lot_number"], df["name"], df["color"], df["entry_date"], df["quantity"].astype(int).tolist()
+            ))
+    return conn
+
+@st.cache_data(show_spinner=False)
+def load_stock(path="stock.db", stamp=None) -> List[StockItem]:
+    with closing(stock_connect(path)) as conn:
+        rows = conn.execute("SELECT name, color, lot_number, entry_date, quantity FROM stock ORDER BY rowid").fetchall()
+    return [StockItem(*row) for row in rows]
+
+def write_stock(rows: dict, path="stock.db"):
+    with closing(stock_connect(path)) as conn:
+        with conn:
+            current = {row[0]: row for row in conn.execute(
+                "SELECT lot_number, name, color, entry_date, quantity FROM stock"
+            )}
+            conn.executemany(STOCK_UPSERT, [row for lot, row in rows.items() if current.get(lot) != row])
+            conn.executemany("DELETE FROM stock WHERE lot_number = ?", [(lot,) for lot in current.keys() - rows.keys()])
+    return file_stamp(path)
+
+def save_stock(stock: List[StockItem], path="stock.db"):
+    # Rien à écrire si le stock n'a pas changé depuis la dernière sauvegarde de la session,
+    # tant que celle-ci n'a pas échoué et que stock.db n'a pas été relu depuis
+    fp = stock_fingerprint(stock)
+    last = session_fps().get(path)
+    if last is not None and last[0] == fp and write_ok(last[1]):
+        return
+    rows = {s.lot_number: (s.lot_number, s.name, s.color, str(s.entry_date), int(s.quantity)) for s in stock}
+    future = save_flusher().submit("stock", write_stock, rows, path)
+    track_write(path, future)
+    load_stock.clear()
+    session_fps()[path] = (fp, future)
 
 
 #---------functions------------
 def generate_serial(quote_no: str, idx: int) -> str:
     return f"{quote_no}-{idx:03d}"
 
+def restock_removed_materials(old_serials: list, new_serials: list, stock_by_lot: dict):
+    # Récrédite les lots d'une ancienne série qui ne sont plus utilisés par la même série ;
+    # une série disparue n'a plus aucun lot utilisé, tout est donc récrédité. Les quantités
+    # sont cumulées par lot d'abord, chaque article de stock n'est modifié qu'une fois.
+    still_lots_by_serial = {}
+    for ns in new_serials:
+        still_lots_by_serial.setdefault(ns["serial"], {m["lot"] for m in ns["materials"]})
+    refund = defaultdict(int)
+    for old in old_serials:
+        still_lots = still_lots_by_serial.get(old["serial"], set())
+        for om in old["materials"]:
+            if om["lot"] not in still_lots:
+                refund[om["lot"]] += om["qty"]
+    for lot, qty in refund.items():
+        stock_item = stock_by_lot.get(lot)
+        if stock_item is not None:
+            stock_item.quantity += qty
+
 
 # -------------------- Load defaults --------------------
-DEFAULT_CATALOG = load_catalog()
-DEFAULT_COMPANY = load_company()
-CLIENTS_DB = load_clients()
-QUOTES_DB = load_quotes()
-STOCK_DB = load_stock()
+# Gardées dans st.session_state avec l'empreinte (mtime, taille) du fichier lu : les reruns
+# réutilisent les données en mémoire tant que le fichier n'a pas changé. Si une autre session
+# (ou un autre onglet) l'a modifié, il est relu, sauf si une écriture de cette session est
+# encore en attente ou a échoué : la mémoire est alors plus à jour que le disque. Si le fichier
+# est exactement celui laissé par la dernière écriture de la session, la mémoire est gardée.
+# Une vraie relecture oublie les empreintes d'écriture du fichier : ce qu'il contient ne vient
+# plus forcément de cette session, la prochaine sauvegarde doit donc l'écrire.
+def session_db(key: str, loader, path: str):
+    stamp = file_stamp(path)
+    loaded = st.session_state.get(key)
+    if loaded is not None and loaded[1] != stamp and stamp is not None and stamp == written_stamp(path):
+        loaded = st.session_state[key] = (loaded[0], stamp)
+    if loaded is None or (loaded[1] != stamp and not has_unsaved_writes(path)):
+        loaded = st.session_state[key] = (loader(path, stamp), stamp)
+        session_fps().pop(path, None)
+    return loaded[0]
+
+DEFAULT_CATALOG = session_db("catalog", load_catalog, "catalog.csv")
+DEFAULT_COMPANY = session_db("company", load_company, "company.csv")
+CLIENTS_DB = session_db("clients", load_clients, "clients.csv")
+QUOTES_DB = session_db("quotes", load_quotes, "quotes.csv")
+STOCK_DB = session_db("stock", load_stock, "stock.db")
+
+# Index reconstruits une fois par rerun : recherche O(1) au lieu de parcourir les listes
+def index_by(rows, attr: str) -> dict:
+    index = {}
+    for row in rows:
+        index.setdefault(getattr(row, attr), row)  # le premier gagne, comme next(...)
+    return index
+
+CATALOG_BY_NAME = index_by(DEFAULT_CATALOG, "description")
+CLIENTS_BY_NAME = index_by(CLIENTS_DB, "name")
+
+# Index des devis par numéro gardé en session, pour la liste QUOTES_DB courante : il est
+# reconstruit si session_db a relu le fichier, et save_quotes l'invalide
+def quotes_by_number() -> dict:
+    cached = st.session_state.get("quotes_by_no")
+    if cached is None or cached[0] is not QUOTES_DB:
+        cached = st.session_state["quotes_by_no"] = (QUOTES_DB, index_by(QUOTES_DB, "number"))
+    return cached[1]
 
 # -------------------- Helpers --------------------
-def money(v: float) -> str:
-    return f"{v:,.2f} €".replace(",", " ").replace(".00", "")
+@lru_cache(maxsize=4096)
+def _money_fixed(fixed: str) -> str:
+    # `fixed` vient de f"{v:.2f}" : même arrondi que l'ancien f"{v:,.2f}" (valeur exacte du
+    # float, au plus proche). Seuls les séparateurs sont ajoutés ; les montants répétés
+    # sortent du cache.
+    units, dot, frac = fixed.partition(".")
+    if not dot:
+        return f"{fixed} €"  # nan, inf
+    sign = "-" if units.startswith("-") else ""
+    units = f"{int(units.lstrip('-')):,}".replace(",", " ")
+    return f"{sign}{units} €" if frac == "00" else f"{sign}{units}.{frac} €"
 
+def money(v: float) -> str:
+    return _money_fixed(f"{v:.2f}")
+
+def quotes_frame(quotes: List[Quote]) -> pd.DataFrame:
+    # Seul le sous-total passe par Python ; la remise et le total sont calculés par NumPy
+    df = pd.DataFrame({
+        "number": [q.number for q in quotes],
+        "date": [q.date for q in quotes],
+        "client": [q.client.name for q in quotes],
+        "subtotal": [sum(i.unit_price * i.quantity for i in q.items) for q in quotes],
+        "discount_value": [q.discount_value for q in quotes],
+        "discount_is_percent": [q.discount_is_percent for q in quotes],
+    })
+    df["total"] = np.where(
+        df["discount_is_percent"],
+        df["subtotal"] * (1 - df["discount_value"] / 100.0),
+        df["subtotal"] - np.minimum(df["discount_value"], df["subtotal"]),
+    )
+    return df
+
+# DataFrame colonne par colonne à partir des attributs : ni liste intermédiaire de dicts
+# (asdict/vars) ni inférence des colonnes à partir de la première ligne
+def records_frame(rows, columns: List[str]) -> pd.DataFrame:
+    return pd.DataFrame({col: [getattr(r, col) for r in rows] for col in columns})
+
+# Le DataFrame de l'éditeur de stock n'est reconstruit que si le contenu du stock change ;
+# `_stock` n'est pas haché par Streamlit, l'empreinte sert de clé.
+def stock_fingerprint(stock) -> int:
+    return hash(tuple((m.name, m.color, m.lot_number, str(m.entry_date), m.quantity) for m in stock))
+
+STOCK_COLUMNS = ["name", "color", "lot_number", "entry_date", "quantity"]
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def stock_frame(fingerprint: int, _stock) -> pd.DataFrame:
+    return records_frame(_stock, STOCK_COLUMNS)
+
+# Compteur de devis du jour gardé en session : QUOTES_DB n'est parcouru qu'une fois par jour
+# (ou après une relecture du fichier), puis count_new_quote() le tient à jour à chaque
+# nouveau devis enregistré.
 def next_quote_number() -> str:
     today = dt.date.today().strftime("%Y%m%d")
-    today_quotes = [q for q in QUOTES_DB if q.number.startswith(today)]
-    return f"{today}-{len(today_quotes)+1:03d}"
+    qn = st.session_state.get("_qn")
+    if qn is None or qn[0] != today or qn[1] is not QUOTES_DB:
+        qn = st.session_state["_qn"] = [today, QUOTES_DB, sum(1 for q in QUOTES_DB if q.number.startswith(today))]
+    return f"{today}-{qn[2]+1:03d}"
+
+def count_new_quote(number: str):
+    qn = st.session_state.get("_qn")
+    if qn is not None and qn[0] == number[:8]:
+        qn[2] += 1
 
 
 # -------------------- PDF Builder --------------------
 
+BEIGE = colors.Color(0.835, 0.914, 0.851)
+
+# Géométrie fixe du tableau : avec largeurs et hauteurs connues, reportlab saute le calcul
+# des dimensions cellule par cellule (stringWidth) au moment du wrap.
+# Une ligne = interligne 12 + marges 3 + 3 du style par défaut (police 10).
+TABLE_COL_WIDTHS = [90*mm, 25*mm, 40*mm, 25*mm]
+TABLE_ROW_HEIGHT = 18
+
+# Style du tableau immuable : construit une seule fois à l'import, pas à chaque PDF
+TABLE_STYLE = TableStyle([
+    ("BACKGROUND", (0,0), (-1,0), BEIGE),
+    ("TEXTCOLOR", (0,0), (-1,0), colors.black),
+    ("FONTNAME", (0,0), (-1,0), "Helvetica-Bold"),
+    ("ALIGN", (1,1), (-1,-1), "RIGHT"),
+    ("ALIGN", (0,0), (0,-1), "LEFT"),
+    ("LINEABOVE", (0,0), (-1,0), 1, colors.black),
+    ("LINEBELOW", (0,0), (-1,0), 1, colors.black),
+    ("LINEBEFORE", (0,0), (-1,0), 1, colors.black),
+    ("LINEAFTER", (0,0), (-1,0), 1, colors.black),
+])
+
+def build_pdf_to_stream(stream, company: Company, client: Client, items: List[Item], discount_value: float,
+                        discount_is_percent: bool, quote_no: str, quote_date: dt.date,
+                        place: str, status="quote", materials: list = None, serials: list = None):
+    # Écrit directement dans un fichier ouvert en binaire (ou un BytesIO) fourni par l'appelant
+    c = canvas.Canvas(stream, pagesize=A4)
+    _draw_quote(c, company, client, items, discount_value, discount_is_percent,
+                quote_no, quote_date, place, status, materials, serials)
+    c.showPage()
+    c.save()
+
 def build_pdf(company: Company, client: Client, items: List[Item], discount_value: float,
               discount_is_percent: bool, quote_no: str, quote_date: dt.date,
               place: str, status="quote", materials: list = None, serials: list = None) -> bytes:
     buf = io.BytesIO()
-    width, height = A4
+    build_pdf_to_stream(buf, company, client, items, discount_value, discount_is_percent,
+                        quote_no, quote_date, place, status, materials, serials)
+    return buf.getvalue()
+
+def build_pdfs_bulk(company: Company, quotes: List[Quote]) -> bytes:
+    # Un seul Canvas pour tout le lot : une page par devis/facture, un seul save()
+    buf = io.BytesIO()
     c = canvas.Canvas(buf, pagesize=A4)
+    for q in quotes:
+        _draw_quote(c, company, q.client, q.items, q.discount_value, q.discount_is_percent,
+                    q.number, q.date, q.place, q.status, q.materials, q.serials)
+        c.showPage()
+    c.save()
+    return buf.getvalue()
+
+def _draw_quote(c: canvas.Canvas, company: Company, client: Client, items: List[Item], discount_value: float,
+                discount_is_percent: bool, quote_no: str, quote_date: dt.date,
+                place: str, status="quote", materials: list = None, serials: list = None):
+    width, height = A4
 
-    beige = colors.Color(0.835, 0.914, 0.851)
-    black = colors.black
     margin = 18*mm
 
     # Background header
-    c.setFillColor(beige)
+    c.setFillColor(BEIGE)
     c.rect(0, height-73*mm, width, height-70*mm, fill=1, stroke=0)
-    c.setFillColor(black)
+    c.setFillColor(colors.black)
     c.rect(0, height-(73*mm)-1, width, 1, fill=1, stroke=0)
 
     # Title
@@ -333,9 +719,11 @@ def build_pdf(company: Company, client: Client, items: List[Item], discount_valu
     subtotal = 0.0
 
     if status == "invoice" and serials:
+        items_by_desc = index_by(items, "description")
         for s in serials:
             # Ligne du produit
-            line_total = next((it.unit_price for it in items if it.description == s["product"]), 0.0)
+            item = items_by_desc.get(s["product"])
+            line_total = item.unit_price if item else 0.0
             subtotal += line_total
             data.append([
                 s["product"],
@@ -362,19 +750,8 @@ def build_pdf(company: Company, client: Client, items: List[Item], discount_valu
     vat_amount = 0.0
     total = subtotal - discount_amount + vat_amount
 
-    table = Table(data, colWidths=[90*mm, 25*mm, 40*mm, 25*mm])
-    style = TableStyle([
-        ("BACKGROUND", (0,0), (-1,0), beige),
-        ("TEXTCOLOR", (0,0), (-1,0), black),
-        ("FONTNAME", (0,0), (-1,0), "Helvetica-Bold"),
-        ("ALIGN", (1,1), (-1,-1), "RIGHT"),
-        ("ALIGN", (0,0), (0,-1), "LEFT"),
-        ("LINEABOVE", (0,0), (-1,0), 1, black),
-        ("LINEBELOW", (0,0), (-1,0), 1, black),
-        ("LINEBEFORE", (0,0), (-1,0), 1, black),
-        ("LINEAFTER", (0,0), (-1,0), 1, black),
-    ])
-    table.setStyle(style)
+    table = Table(data, colWidths=TABLE_COL_WIDTHS, rowHeights=[TABLE_ROW_HEIGHT] * len(data))
+    table.setStyle(TABLE_STYLE)
     table.wrapOn(c, 0, 0)
     table.drawOn(c, margin, y2-table._height-5)
 
@@ -416,12 +793,39 @@ def build_pdf(company: Company, client: Client, items: List[Item], discount_valu
         c.setFont("Helvetica", 10)
         c.drawCentredString(width/2, 5*mm, "Ce devis est valable 30 jours calendaires")
 
-    c.showPage()
-
 
-    c.save()
-    buf.seek(0)
-    return(buf.read())
+# Le rendu reportlab est coûteux : on le mémorise sur une empreinte du contenu, ce qui
+# évite de régénérer le même PDF à chaque clic ou rerun. Les dataclasses ne sont pas
+# hachées par Streamlit (paramètres préfixés par `_`), seule l'empreinte sert de clé.
+@st.cache_data(max_entries=64, show_spinner=False)
+def _cached_pdf(key: str, _args: tuple, _kwargs: dict) -> bytes:
+    return build_pdf(*_args, **_kwargs)
+
+def pdf_content_key(*args, **kwargs) -> str:
+    return hashlib.blake2b(repr((args, sorted(kwargs.items()))).encode(), digest_size=16).hexdigest()
+
+def build_pdf_cached(*args, **kwargs) -> bytes:
+    return _cached_pdf(pdf_content_key(*args, **kwargs), args, kwargs)
+
+# Pool partagé entre les sessions (cache_resource), pour générer les PDF hors du rerun
+@st.cache_resource
+def pdf_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=2)
+
+def submit_pdf(state_key: str, *args, **kwargs):
+    # Un seul emplacement par state_key : une nouvelle tâche remplace la précédente, seul le
+    # PDF en cours d'affichage reste en session. La mémorisation est celle de _cached_pdf,
+    # appelé par la tâche : revenir à un contenu déjà rendu ne relance pas reportlab.
+    # Les arguments sont copiés car les widgets des reruns suivants modifient les objets.
+    key = pdf_content_key(*args, **kwargs)
+    job = st.session_state.get(state_key)
+    if job is None or job[0] != key:
+        if job is not None:
+            job[1].cancel()  # rendu périmé : ne pas occuper le pool partagé s'il n'a pas démarré
+        args, kwargs = copy.deepcopy((args, kwargs))
+        job = (key, pdf_pool().submit(_cached_pdf, key, args, kwargs))
+        st.session_state[state_key] = job
+    return job[1]
 
 
 #-------UI----------
@@ -429,6 +833,15 @@ def build_pdf(company: Company, client: Client, items: List[Item], discount_valu
 st.set_page_config(page_title="Éditeur de Devis", page_icon="📄", layout="wide")
 st.title("📄 Éditeur de Devis")
 
+# Écritures en arrière-plan en échec : signalées au rerun suivant. La mémoire reste à jour
+# (session_db ne relit pas le fichier), « Réessayer » la réécrit en entier.
+RETRY_SAVES = {"stock.db": (save_stock, STOCK_DB), "quotes.csv": (save_quotes, QUOTES_DB)}
+for path, future in list(st.session_state.get("_writes", {}).items()):
+    if future.done() and future.exception() is not None:
+        st.error(f"Échec de l'enregistrement de {path} : {future.exception()}. Les modifications ne sont pas sauvegardées.")
+        save, data = RETRY_SAVES[path]
+        st.button("🔁 Réessayer", key=f"retry_{path}", on_click=save, args=(data, path))
+
 tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["📑 Devis", "🏢 Entreprise", "📦 Catalogue", "👥 Clients", "💶 Factures", "📦 Stock"])
 
 # --- TAB 1: Devis generator ---
@@ -437,7 +850,7 @@ with tab1:
     if not quotes:
         st.info("Aucun devis enregistré")
     else:
-        df_quot = pd.DataFrame([{**vars(quot), "client": quot.client.name, "total": sum(i.unit_price * i.quantity for i in quot.items) - (sum(i.unit_price * i.quantity for i in quot.items) * (quot.discount_value/100 if quot.discount_is_percent else 0))} for quot in quotes])
+        df_quot = quotes_frame(quotes)
         st.dataframe(df_quot[["number", "date", "client", "total"]])
 
     with st.sidebar:
@@ -453,7 +866,7 @@ with tab1:
 
     st.subheader("Ouvrir un devis existant")
     sel_quote = st.selectbox("Choisir un devis", options=[q.number for q in QUOTES_DB if q.status=="quote"], index=None)
-    selected_quote = next((q for q in QUOTES_DB if q.number == sel_quote), None)
+    selected_quote = quotes_by_number().get(sel_quote)
 
     if selected_quote:
         cli = selected_quote.client
@@ -480,7 +893,7 @@ with tab1:
         sel_client = st.selectbox(
             "Sélectionnez un client", options=[client.name for client in CLIENTS_DB], index=None
         )
-        selected_client = next((c for c in CLIENTS_DB if c.name == sel_client), None)
+        selected_client = CLIENTS_BY_NAME.get(sel_client)
         cli = Client(
             name=st.text_input("Nom du client", value=selected_client.name if selected_client else ""),
             address=st.text_input("Adresse du client", value=selected_client.address if selected_client else ""),
@@ -494,7 +907,7 @@ with tab1:
         )
         lines: List[Item] = []
         for name in sel_names:
-            base = next((it for it in DEFAULT_CATALOG if it.description == name), None)
+            base = CATALOG_BY_NAME.get(name)
             with st.container(border=True):
                 desc = st.text_input("Description", value=base.description if base else name, key=f"d_{name}")
                 col1, col2 = st.columns(2)
@@ -518,9 +931,11 @@ with tab1:
     st.metric("Total", money(total))
 
     if st.button("💾 Sauvegarder et Générer PDF"):
-        existing = next((q for q in QUOTES_DB if q.number == quote_no), None)
+        existing = quotes_by_number().get(quote_no)
         if existing:
             QUOTES_DB.remove(existing)
+        else:
+            count_new_quote(quote_no)
         new_quote = Quote(
             number=quote_no,
             date=quote_date,
@@ -532,15 +947,15 @@ with tab1:
             status="quote"
         )
         QUOTES_DB.append(new_quote)
-        save_quotes(QUOTES_DB)
+        save_one_quote(new_quote, QUOTES_DB)
 
-        pdf_bytes = build_pdf(comp, cli, lines, discount_value, discount_is_percent, quote_no, quote_date, place, status="quote")
+        pdf_bytes = build_pdf_cached(comp, cli, lines, discount_value, discount_is_percent, quote_no, quote_date, place, status="quote")
         st.download_button("Télécharger le devis (PDF)", pdf_bytes, file_name=f"devis_{quote_no}.pdf", mime="application/pdf")
 
     # Bouton séparé pour transformer en facture
     if selected_quote and st.button("Transformer ce devis en facture"):
         selected_quote.status = "invoice"
-        save_quotes(QUOTES_DB)
+        save_one_quote(selected_quote, QUOTES_DB)
         st.success(f"Devis {selected_quote.number} transformé en facture ✅")
 
 
@@ -556,29 +971,32 @@ with tab2:
         phone = st.text_input("Téléphone", DEFAULT_COMPANY["phone"])
         email = st.text_input("E-mail", DEFAULT_COMPANY["email"])
         if st.form_submit_button("💾 Sauvegarder"):
-            save_company({"name": name, "siret": siret, "address": address, "rm": rm, "phone": phone, "email": email})
+            DEFAULT_COMPANY.update({"name": name, "siret": siret, "address": address, "rm": rm, "phone": phone, "email": email})
+            save_company(DEFAULT_COMPANY)
             st.success("Informations entreprise sauvegardées ✅")
 
 
 # --- TAB 3: Catalog Editor ---
 with tab3:
     st.subheader("Modifier le catalogue")
-    df = pd.DataFrame([vars(it) for it in DEFAULT_CATALOG])
+    df = records_frame(DEFAULT_CATALOG, ["description", "unit_price", "quantity"])
     edited = st.data_editor(df, num_rows="dynamic", key="editor_catalog")
     if st.button("💾 Sauvegarder le catalogue"):
         items = [Item(row["description"], float(row["unit_price"]), int(row["quantity"])) for _, row in edited.iterrows()]
         save_catalog(items)
+        DEFAULT_CATALOG[:] = items
         st.success("Catalogue sauvegardé ✅")
 
 
 # --- TAB 4: Clients Database ---
 with tab4:
     st.subheader("Modifier la base clients")
-    dc = pd.DataFrame([vars(it) for it in CLIENTS_DB])
+    dc = records_frame(CLIENTS_DB, ["name", "address", "phone", "email", "city"])
     edited_clients = st.data_editor(dc, num_rows="dynamic", key="editor_clients")
     if st.button("💾 Sauvegarder les clients"):
         clients = [Client(row["name"], row["address"], row["phone"], row["email"], row["city"]) for _, row in edited_clients.iterrows()]
         save_clients(clients)
+        CLIENTS_DB[:] = clients
         st.success("Clients sauvegardés ✅")
 
 # --- TAB 5: Factures ---
@@ -588,25 +1006,25 @@ with tab5:
     if not invoices:
         st.info("Aucune facture enregistrée")
     else:
-        df_inv = pd.DataFrame([
-            {
-                **vars(inv),
-                "client": inv.client.name,
-                "total": sum(i.unit_price * i.quantity for i in inv.items)
-                        - (sum(i.unit_price * i.quantity for i in inv.items)
-                           * (inv.discount_value / 100 if inv.discount_is_percent else 0))
-            }
-            for inv in invoices
-        ])
+        df_inv = quotes_frame(invoices)
         st.dataframe(df_inv[["number", "date", "client", "total"]])
 
+        if st.button("📚 Générer toutes les factures (PDF)", key="bulk_invoices"):
+            st.download_button(
+                "Télécharger toutes les factures (PDF)",
+                build_pdfs_bulk(comp, invoices),
+                file_name="factures.pdf",
+                mime="application/pdf",
+                key="dl_all_invoices"
+            )
+
         sel_invoice = st.selectbox(
             "Choisir une facture à éditer",
             options=[inv.number for inv in invoices],
             index=None,
             key="sel_invoice"
         )
-        selected_invoice = next((inv for inv in invoices if inv.number == sel_invoice), None)
+        selected_invoice = quotes_by_number().get(sel_invoice)
 
         if selected_invoice:
             cli = selected_invoice.client
@@ -650,6 +1068,24 @@ with tab5:
             new_serials = []
             serial_counter = 1
 
+            # Index des lots et libellés des lots disponibles, construits seulement quand
+            # une facture est ouverte, en un seul passage sur le stock
+            stock_by_lot = {}
+            lot_labels = {}
+            for m in STOCK_DB:
+                stock_by_lot.setdefault(m.lot_number, m)
+                if m.quantity > 0:
+                    lot_labels.setdefault(m.lot_number, f"{m.name} - Lot {m.lot_number} ({m.quantity} restants)")
+            lot_options = list(lot_labels.values())
+
+            # Anciennes quantités par série puis par lot, construites une fois pour le rendu
+            # et la sauvegarde : plus de next(...) par série ni par lot
+            old_by_serial = {}
+            for s in old_serials:
+                lots = old_by_serial.setdefault(s["serial"], {})
+                for mat in s["materials"]:
+                    lots.setdefault(mat["lot"], mat["qty"])  # le premier gagne, comme next(...)
+
             for i, it in enumerate(lines):
                 for q in range(it.quantity):
                     serial = generate_serial(quote_no, serial_counter)
@@ -657,19 +1093,9 @@ with tab5:
 
                     st.markdown(f"#### {it.description} — Série {serial}")
 
-                    lot_options = [
-                        f"{m.name} - Lot {m.lot_number} ({m.quantity} restants)"
-                        for m in STOCK_DB if m.quantity > 0
-                    ]
-
                     # anciens matériaux pour ce numéro de série
-                    old_entry = next((s for s in old_serials if s["serial"] == serial), None)
-                    preselected = []
-                    if old_entry:
-                        for mat in old_entry["materials"]:
-                            match = next((opt for opt in lot_options if f"Lot {mat['lot']}" in opt), None)
-                            if match:
-                                preselected.append(match)
+                    old_qtys = old_by_serial.get(serial, {})
+                    preselected = [lot_labels[lot] for lot in old_qtys if lot in lot_labels]
 
                     selected_lots = st.multiselect(
                         f"Lots utilisés pour série {serial}",
@@ -681,11 +1107,9 @@ with tab5:
                     materials_for_serial = []
                     for sel in selected_lots:
                         lot_id = sel.split("Lot ")[1].split(" ")[0]
-                        material = next((m for m in STOCK_DB if m.lot_number == lot_id), None)
+                        material = stock_by_lot.get(lot_id)
                         if material:
-                            old_qty = 1
-                            if old_entry:
-                                old_qty = next((mat["qty"] for mat in old_entry["materials"] if mat["lot"] == lot_id), 1)
+                            old_qty = old_qtys.get(lot_id, 1)
                             qty_used = st.number_input(
                                 f"Quantité utilisée de {material.name} (Lot {material.lot_number})",
                                 min_value=1,
@@ -708,34 +1132,17 @@ with tab5:
             # Bouton Sauvegarde facture + ajustement stock
             if st.button("💾 Sauvegarder la facture", key=f"save_invoice_{quote_no}"):
 
-                # Ajustement stock par différence
+                # Ajustement stock par différence (stock_by_lot contient les mêmes objets que STOCK_DB)
                 for ns in new_serials:
-                    old_entry = next((s for s in old_serials if s["serial"] == ns["serial"]), None)
+                    old_qtys = old_by_serial.get(ns["serial"], {})
                     for mat in ns["materials"]:
-                        stock_item = next((m for m in STOCK_DB if m.lot_number == mat["lot"]), None)
+                        stock_item = stock_by_lot.get(mat["lot"])
                         if stock_item:
-                            old_qty = 0
-                            if old_entry:
-                                old_qty = next((m2["qty"] for m2 in old_entry["materials"] if m2["lot"] == mat["lot"]), 0)
-                            diff = mat["qty"] - old_qty
+                            diff = mat["qty"] - old_qtys.get(mat["lot"], 0)
                             stock_item.quantity -= diff
 
                 # Récréditer les lots qui ont disparu
-                for old in old_serials:
-                    still_present = next((ns for ns in new_serials if ns["serial"] == old["serial"]), None)
-                    if still_present:
-                        for om in old["materials"]:
-                            still_used = any(m["lot"] == om["lot"] for m in still_present["materials"])
-                            if not still_used:
-                                stock_item = next((m for m in STOCK_DB if m.lot_number == om["lot"]), None)
-                                if stock_item:
-                                    stock_item.quantity += om["qty"]
-                    else:
-                        # toute la série a disparu → tout récréditer
-                        for om in old["materials"]:
-                            stock_item = next((m for m in STOCK_DB if m.lot_number == om["lot"]), None)
-                            if stock_item:
-                                stock_item.quantity += om["qty"]
+                restock_removed_materials(old_serials, new_serials, stock_by_lot)
 
                 # Mise à jour de la facture
                 selected_invoice.client = cli
@@ -746,11 +1153,13 @@ with tab5:
                 selected_invoice.serials = new_serials
 
                 save_stock(STOCK_DB)
-                save_quotes(QUOTES_DB)
+                save_one_quote(selected_invoice, QUOTES_DB)
                 st.success("Facture mise à jour et stock ajusté ✅")
 
-            # Génération PDF avec traçabilité
-            pdf_bytes = build_pdf(
+            # Génération PDF avec traçabilité, en arrière-plan : le rerun n'attend le résultat
+            # que s'il est prêt ou si l'utilisateur demande explicitement le PDF
+            pdf_future = submit_pdf(
+                "invoice_pdf",
                 comp, cli, lines,
                 discount_value, discount_is_percent,
                 quote_no, quote_date, place,
@@ -758,31 +1167,51 @@ with tab5:
                 materials=[],
                 serials=selected_invoice.serials or []
             )
-            st.download_button(
-                "Télécharger la facture (PDF)",
-                pdf_bytes,
-                file_name=f"facture_{quote_no}.pdf",
-                mime="application/pdf",
-                key=f"dl_invoice_{quote_no}"
-            )
+            if pdf_future.done() or st.button("📄 Préparer la facture (PDF)", key=f"prep_invoice_{quote_no}"):
+                st.download_button(
+                    "Télécharger la facture (PDF)",
+                    pdf_future.result(),
+                    file_name=f"facture_{quote_no}.pdf",
+                    mime="application/pdf",
+                    key=f"dl_invoice_{quote_no}"
+                )
+            else:
+                st.caption("PDF de la facture en cours de génération…")
 
 # --- TAB 6: stock ---
 
 with tab6:
     st.subheader("Gestion du stock de matières premières")
 
-    df_stock = pd.DataFrame([vars(m) for m in STOCK_DB])
+    df_stock = stock_frame(stock_fingerprint(STOCK_DB), STOCK_DB)
     edited_stock = st.data_editor(df_stock, num_rows="dynamic", key="editor_stock")
 
     if st.button("💾 Sauvegarder le stock"):
+        # Conversion colonne par colonne au lieu d'une Series par ligne avec iterrows() ;
+        # les dates passent en une fois par le parseur C de pandas
+        # Le numéro de lot est la clé de stock.db : vide ou en double, la ligne écraserait une
+        # autre ou s'accumulerait sans clé, rien n'est donc sauvegardé
         new_stock = []
-        for _, row in edited_stock.iterrows():
-            new_stock.append(RawMaterial(
-                name=row["name"],
-                lot_number=row["lot_number"],
-                entry_date=row["entry_date"] if isinstance(row["entry_date"], dt.date) else dt.datetime.strptime(str(row["entry_date"]), "%Y-%m-%d").date(),
-                quantity=int(row["quantity"])
-            ))
-        save_stock(new_stock)
-        st.success("Stock sauvegardé ✅")
-        STOCK_DB[:] = new_stock
+        bad_lots = []
+        missing_lots = 0
+        dup_lots = []
+        if not edited_stock.empty:
+            dates = pd.to_datetime(edited_stock["entry_date"], format="%Y-%m-%d", errors="coerce")
+            bad_lots = edited_stock.loc[dates.isna(), "lot_number"].tolist()
+            lots = edited_stock["lot_number"].fillna("").astype(str).str.strip()
+            missing_lots = int((lots == "").sum())
+            dup_lots = lots[(lots != "") & lots.duplicated()].unique().tolist()
+            new_stock = [
+                RawMaterial(name=n, lot_number=l, entry_date=d, quantity=int(q))
+                for n, l, d, q in zip(edited_stock["name"], edited_stock["lot_number"], dates.dt.date, edited_stock["quantity"].astype(int))
+            ]
+        if missing_lots:
+            st.error(f"Numéro de lot manquant sur {missing_lots} ligne(s)")
+        if dup_lots:
+            st.error(f"Numéros de lot en double : {', '.join(dup_lots)}")
+        if bad_lots:
+            st.error(f"Date d'entrée invalide (AAAA-MM-JJ attendu) pour les lots : {', '.join(map(str, bad_lots))}")
+        if not (missing_lots or dup_lots or bad_lots):
+            save_stock(new_stock)
+            st.success("Stock sauvegardé ✅")
+            STOCK_DB[:] = new_stock